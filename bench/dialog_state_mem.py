@@ -0,0 +1,47 @@
+# bench/dialog_state_mem.py — память DialogStore при 1M пользователей посреди диалога
+#
+#   python bench/dialog_state_mem.py [users]
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp())  # main создаёт bot.db в текущей папке при импорте
+import main
+
+def measure(fill, users):
+    tracemalloc.start()
+    started = time.perf_counter()
+    store = fill(users)
+    elapsed = time.perf_counter() - started
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return store, current, elapsed
+
+def fill_user_data(users):
+    # Как было раньше: копия настроек плюс ключи шага в context.user_data
+    data = {}
+    for uid in range(users):
+        user_id = 100_000_000 + uid
+        data[user_id] = {"user_id": user_id, "lang": "ru", "theme": "light", "favorites": "USD,EUR,RUB".split(","),
+                         "awaiting": "to_currency", "amount": float(uid), "from_curr": "USD"}
+    return data
+
+def fill_dialog_store(users):
+    store = main.DialogStore(max_users=users)
+    for uid in range(users):
+        store.update(100_000_000 + uid, awaiting="to_currency", amount=float(uid), from_curr="USD")
+    return store
+
+def main_bench():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    for name, fill in (("user_data dicts", fill_user_data), ("DialogStore", fill_dialog_store)):
+        store, current, elapsed = measure(fill, users)
+        print(f"{name:16} {len(store):>9} users  {current / 1e6:8.1f} MB  {current / users:6.0f} B/user  {elapsed:6.1f} s")
+        del store
+
+if __name__ == "__main__":
+    main_bench()
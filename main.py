@@ -2,13 +2,21 @@
 
 import os
 import re
+import argparse
+import asyncio
+import csv
+import gzip
+import tempfile
+import sys
+import time
 import requests
 import sqlite3
 import json
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler, InlineQueryHandler
-import matplotlib.pyplot as plt
+from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler, InlineQueryHandler, BaseUpdateProcessor
+from matplotlib.figure import Figure
 import io
 
 # ===================================
@@ -16,6 +24,16 @@ TOKEN = os.getenv("TOKEN")
 DB_PATH = "bot.db"
 # ===================================
 
+# --- Уникальный индекс курсов ---
+def build_rate_index(cur):
+    # Пересекающиеся файлы загрузки могли дать дубли — оставляем последнюю загруженную запись
+    cur.execute("""
+        DELETE FROM rates WHERE rowid NOT IN (
+            SELECT MAX(rowid) FROM rates GROUP BY day, currency
+        )
+    """)
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_rates_day_curr ON rates (day, currency)")
+
 # --- Инициализация базы данных ---
 def init_db():
     conn = sqlite3.connect(DB_PATH)
@@ -39,6 +57,7 @@ def init_db():
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_history_user_ts ON history (user_id, timestamp)")
     cur.execute("""
         CREATE TABLE IF NOT EXISTS alerts (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -48,6 +67,28 @@ def init_db():
             target REAL
         )
     """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS rates (
+            day TEXT,
+            currency TEXT,
+            rate REAL
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS import_progress (
+            path TEXT PRIMARY KEY,
+            offset INTEGER,
+            rows INTEGER,
+            done INTEGER DEFAULT 0
+        )
+    """)
+    # Пока загрузка курсов не завершена, индекса нет (его снимает backfill_main), а в таблице
+    # могут быть дубли — строим его только когда все начатые загрузки закончены
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_rates_day_curr'")
+    has_index = cur.fetchone()
+    cur.execute("SELECT 1 FROM import_progress WHERE done = 0 LIMIT 1")
+    if not has_index and not cur.fetchone():
+        build_rate_index(cur)
     conn.commit()
     conn.close()
 
@@ -90,6 +131,181 @@ class CurrencyCache:
 
 cache = CurrencyCache()
 
+# --- Состояние диалогов ---
+STATE_TTL = 15 * 60        # секунд, после которых брошенный диалог сбрасывается
+STATE_MAX_USERS = 200_000  # сколько незавершённых диалогов держать в памяти
+
+class DialogState:
+    __slots__ = ("awaiting", "amount", "from_curr", "to_curr", "alert_currency", "expires")
+
+    def __init__(self):
+        self.awaiting = None
+        self.amount = None
+        self.from_curr = None
+        self.to_curr = None
+        self.alert_currency = None
+        self.expires = 0.0
+
+class DialogStore:
+    def __init__(self, ttl=STATE_TTL, max_users=STATE_MAX_USERS):
+        self.ttl = ttl
+        self.max_users = max_users
+        # Порядок = порядок последнего обновления, поэтому просроченные записи всегда в начале
+        self._states = OrderedDict()
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, user_id):
+        state = self._states.get(user_id)
+        if state is None:
+            return None
+        if state.expires < time.monotonic():
+            del self._states[user_id]
+            return None
+        return state
+
+    def update(self, user_id, **fields):
+        state = self.get(user_id)
+        if state is None:
+            state = DialogState()
+            self._states[user_id] = state
+            while len(self._states) > self.max_users:
+                self._states.popitem(last=False)
+        else:
+            self._states.move_to_end(user_id)
+        for name, value in fields.items():
+            # Коды валют и шаги повторяются у всех пользователей — храним одну копию строки
+            setattr(state, name, sys.intern(value) if isinstance(value, str) else value)
+        state.expires = time.monotonic() + self.ttl
+        return state
+
+    def clear(self, user_id):
+        self._states.pop(user_id, None)
+
+    def purge(self):
+        now = time.monotonic()
+        while self._states:
+            user_id, state = next(iter(self._states.items()))
+            if state.expires >= now:
+                break
+            del self._states[user_id]
+
+states = DialogStore()
+
+# --- Ограничение нагрузки от пользователей ---
+RATE_PER_SEC = 1.0       # сколько единиц стоимости восстанавливается в секунду
+RATE_BURST = 10          # ёмкость ведра
+HEAVY_COST = 5           # команды не дешевле этого идут через общий пул тяжёлых задач
+HEAVY_WORKERS = 2        # сколько тяжёлых задач выполняется одновременно
+ADMISSION_MAX_USERS = 200_000  # сколько вёдер держать в памяти
+USER_MAX_PENDING = 20          # сколько обновлений одного пользователя может ждать очереди
+COMMAND_COSTS = {"graph": HEAVY_COST, "export": HEAVY_COST}
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated", "warned")
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+        self.warned = False
+
+class AdmissionControl:
+    def __init__(self, rate=RATE_PER_SEC, burst=RATE_BURST, heavy_workers=HEAVY_WORKERS, max_users=ADMISSION_MAX_USERS):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self._buckets = OrderedDict()
+        # Semaphore будит ожидающих по очереди, а у каждого пользователя не больше одной
+        # тяжёлой задачи от допуска до завершения — так пул делится между пользователями по кругу
+        self._heavy = asyncio.Semaphore(heavy_workers)
+        self._busy = set()
+
+    def admit(self, user_id, cost):
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.burst, now)
+            self._buckets[user_id] = bucket
+            while len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        if cost >= HEAVY_COST and user_id in self._busy:
+            return False
+        if bucket.tokens < cost:
+            return False
+        bucket.tokens -= cost
+        bucket.warned = False
+        if cost >= HEAVY_COST:
+            self._busy.add(user_id)
+        return True
+
+    def release(self, user_id):
+        self._busy.discard(user_id)
+
+    def should_warn(self, user_id):
+        # Предупреждаем один раз за серию отказов, остальные запросы отбрасываем молча
+        bucket = self._buckets.get(user_id)
+        if bucket is None or bucket.warned:
+            return False
+        bucket.warned = True
+        return True
+
+    async def run_heavy(self, func, *args):
+        async with self._heavy:
+            return await asyncio.to_thread(func, *args)
+
+admission = AdmissionControl()
+
+class UserOrderedProcessor(BaseUpdateProcessor):
+    # Обновления разных пользователей идут параллельно, одного пользователя — строго по порядку,
+    # иначе шаги диалога из DialogStore перепутаются. Лимит проверяется сразу при получении,
+    # до очереди пользователя: отказ ничего не ждёт, а в очередь попадают только допущенные
+    def __init__(self, max_concurrent_updates=256, max_pending=USER_MAX_PENDING):
+        super().__init__(max_concurrent_updates)
+        self.max_pending = max_pending
+        self._locks = {}
+        self._pending = {}
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            await coroutine
+            return
+        cost = update_cost(update)
+        if self._pending.get(user.id, 0) >= self.max_pending or not admission.admit(user.id, cost):
+            coroutine.close()
+            await reject_update(update, user.id)
+            return
+        lock = self._locks.setdefault(user.id, asyncio.Lock())
+        self._pending[user.id] = self._pending.get(user.id, 0) + 1
+        try:
+            async with lock:
+                await coroutine
+        finally:
+            if cost >= HEAVY_COST:
+                admission.release(user.id)
+            self._pending[user.id] -= 1
+            if not self._pending[user.id]:
+                del self._pending[user.id]
+                del self._locks[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def update_cost(update: Update):
+    message = update.message
+    if message and message.text and message.text.startswith("/"):
+        command = message.text[1:].split(maxsplit=1)[0].split("@")[0].lower()
+        return COMMAND_COSTS.get(command, 1)
+    return 1
+
 # --- Получить настройки пользователя ---
 def get_user_settings(user_id):
     conn = sqlite3.connect(DB_PATH)
@@ -155,6 +371,79 @@ def get_recent_history(user_id, limit=3):
     conn.close()
     return rows
 
+# --- Выгрузить всю историю в gzip-файлы (CSV или JSON Lines) ---
+EXPORT_FORMATS = ("csv", "jsonl")
+EXPORT_CHUNK = 1000
+EXPORT_PART_SIZE = 45 * 1024 * 1024  # Telegram принимает от бота файлы до 50 МБ
+
+class ExportPart:
+    def __init__(self, fmt):
+        self.file = tempfile.TemporaryFile()
+        self.gz = gzip.GzipFile(fileobj=self.file, mode="wb")
+        self.text = io.TextIOWrapper(self.gz, encoding="utf-8", newline="")
+        self.writer = csv.writer(self.text)
+        self.rows = 0
+        if fmt == "csv":
+            self.writer.writerow(["timestamp", "from_curr", "to_curr", "amount", "result"])
+
+    def size(self):
+        return self.file.tell()
+
+    def finish(self):
+        self.text.flush()
+        self.text.detach()
+        self.gz.close()
+        self.file.seek(0)
+        return self.file
+
+def export_history(user_id, fmt="csv", date_from=None, date_to=None, part_size=EXPORT_PART_SIZE):
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+    query = "SELECT timestamp, from_curr, to_curr, amount, result FROM history WHERE user_id = ?"
+    params = [user_id]
+    if date_from:
+        query += " AND timestamp >= ?"
+        params.append(date_from)
+    if date_to:
+        query += " AND timestamp < date(?, '+1 day')"
+        params.append(date_to)
+    query += " ORDER BY timestamp"
+    cur.execute(query, params)
+
+    # Строки читаются курсором порциями и сразу сжимаются во временные файлы на диске.
+    # Когда часть дорастает до part_size, начинается следующая — каждая отправляется отдельно
+    parts = []
+    part = None
+    count = 0
+    try:
+        while True:
+            rows = cur.fetchmany(EXPORT_CHUNK)
+            if not rows:
+                break
+            if part is None or part.size() >= part_size:
+                if part is not None:
+                    parts.append(part.finish())
+                part = ExportPart(fmt)
+            if fmt == "csv":
+                part.writer.writerows(rows)
+            else:
+                for timestamp, from_curr, to_curr, amount, result in rows:
+                    part.text.write(json.dumps({"timestamp": timestamp, "from_curr": from_curr, "to_curr": to_curr,
+                                                "amount": amount, "result": result}, ensure_ascii=False) + "\n")
+            part.rows += len(rows)
+            count += len(rows)
+        if part is not None:
+            parts.append(part.finish())
+    except Exception:
+        if part is not None:
+            part.file.close()
+        for f in parts:
+            f.close()
+        raise
+    finally:
+        conn.close()
+    return count, parts
+
 # --- Получить избранные валюты ---
 def get_favorites(user_id):
     settings = get_user_settings(user_id)
@@ -173,10 +462,12 @@ LANGS = {
                 "• /alert — уведомление\n"
                 "• /theme dark — тема\n"
                 "• /fav USD,EUR — избранное\n"
-                "• /history — история",
+                "• /history — история\n"
+                "• /export csv 2026-01-01 2026-06-30 — выгрузка истории",
         "convert": "💱 Введи сумму и валюту:\nНапример: `100 USD`",
         "history": "📜 Твоя история:",
         "no_history": "📜 История пуста.",
+        "no_history_range": "📜 За этот период записей нет.",
         "lang_set": "🌐 Язык установлен: ",
         "lang_error": "❌ Неподдерживаемый язык.",
         "alert_set": "✅ Уведомление установлено: ",
@@ -196,10 +487,12 @@ LANGS = {
                 "• /alert — notify\n"
                 "• /theme dark — theme\n"
                 "• /fav USD,EUR — favorites\n"
-                "• /history — history",
+                "• /history — history\n"
+                "• /export csv 2026-01-01 2026-06-30 — export history",
         "convert": "💱 Enter amount and currency:\nExample: `100 USD`",
         "history": "📜 Your history:",
         "no_history": "📜 History is empty.",
+        "no_history_range": "📜 No history for this period.",
         "lang_set": "🌐 Language set to: ",
         "lang_error": "❌ Unsupported language.",
         "alert_set": "✅ Alert set: ",
@@ -210,8 +503,8 @@ LANGS = {
     }
 }
 
-def t(user_data, key):
-    lang = user_data.get('lang', 'ru')
+def t(settings, key):
+    lang = settings.get('lang', 'ru')
     return LANGS[lang].get(key, LANGS['ru'][key])
 
 # --- Темы ---
@@ -234,9 +527,9 @@ THEMES = {
     }
 }
 
-def get_menu(user_data):
-    theme = user_data.get("theme", "light")
-    lang = user_data.get("lang", "ru")
+def get_menu(settings):
+    theme = settings.get("theme", "light")
+    lang = settings.get("lang", "ru")
     menu = THEMES[theme]["menu"]
     if lang == "ru":
         menu = [
@@ -251,7 +544,6 @@ def get_menu(user_data):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     settings = get_user_settings(user_id)
-    context.user_data.update(settings)
 
     if cache.is_expired():
         await cache.update_rates()
@@ -264,7 +556,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         callback = f"repeat:{from_curr}:{to_curr}:{amount}"
         buttons.append([InlineKeyboardButton(text, callback_data=callback)])
 
-    text = t(context.user_data, "start")
+    text = t(settings, "start")
     if buttons:
         text += "\n\n*Последние действия:*"
         reply_markup = InlineKeyboardMarkup(buttons)
@@ -272,11 +564,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(text, parse_mode='Markdown')
 
-    await update.message.reply_text("Выбери действие:", reply_markup=get_menu(context.user_data))
+    await update.message.reply_text("Выбери действие:", reply_markup=get_menu(settings))
 
 # --- /help ---
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(t(context.user_data, "help"), parse_mode='Markdown')
+    settings = get_user_settings(update.effective_user.id)
+    await update.message.reply_text(t(settings, "help"), parse_mode='Markdown')
 
 # --- /theme ---
 async def theme_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -287,28 +580,44 @@ async def theme_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     theme = context.args[0]
     if theme in ["dark", "light"]:
         save_user_settings(user_id, theme=theme)
-        context.user_data["theme"] = theme
-        await update.message.reply_text(t(context.user_data, "theme_set") + theme)
+        settings = get_user_settings(user_id)
+        await update.message.reply_text(t(settings, "theme_set") + theme)
         # Обновить меню
-        await update.message.reply_text("Меню обновлено", reply_markup=get_menu(context.user_data))
+        await update.message.reply_text("Меню обновлено", reply_markup=get_menu(settings))
     else:
         await update.message.reply_text("Темы: dark, light")
 
 # --- /fav ---
 async def fav_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
+    settings = get_user_settings(user_id)
     if not context.args:
-        await update.message.reply_text(t(context.user_data, "fav_error"), parse_mode='Markdown')
+        await update.message.reply_text(t(settings, "fav_error"), parse_mode='Markdown')
         return
     favs = [f.upper() for f in context.args[0].split(",")]
     save_user_settings(user_id, favorites=favs)
-    context.user_data["favorites"] = favs
-    await update.message.reply_text(t(context.user_data, "fav_set") + ", ".join(favs))
+    await update.message.reply_text(t(settings, "fav_set") + ", ".join(favs))
 
 # --- /convert ---
 async def convert_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(t(context.user_data, "convert"), parse_mode='Markdown')
-    context.user_data['awaiting'] = 'amount'
+    user_id = update.effective_user.id
+    settings = get_user_settings(user_id)
+    states.update(user_id, awaiting='amount')
+    await update.message.reply_text(t(settings, "convert"), parse_mode='Markdown')
+
+# --- Калькулятор ---
+CALC_MAX_LEN = 100          # длиннее выражение не считаем
+CALC_MAX_VALUE = 1e15       # больше сумма не имеет смысла для конвертации
+
+def calc_eval(expr):
+    # Регулярка пропускает только цифры, скобки и + - * /, но "**" позволяет
+    # вычислять огромные степени и надолго занять цикл событий — запрещаем
+    if len(expr) > CALC_MAX_LEN or "**" in expr:
+        raise ValueError("expression too long or uses **")
+    amount = eval(expr, {"__builtins__": {}})
+    if abs(amount) > CALC_MAX_VALUE:
+        raise ValueError("amount too large")
+    return amount
 
 # --- /quick ---
 async def quick_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -319,7 +628,7 @@ async def quick_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     expr, from_curr, to_curr = match.groups()
     try:
-        amount = eval(expr)
+        amount = calc_eval(expr)
     except:
         await update.message.reply_text("Ошибка в выражении")
         return
@@ -337,6 +646,24 @@ async def quick_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"✅ {amount} {from_curr} = {result:,.2f} {to_curr}")
 
 # --- /graph ---
+def render_graph(currency, base_rate):
+    # Рисуем без pyplot: глобальное состояние pyplot небезопасно при рендере в потоках
+    days = list(range(1, 8))
+    rates = [base_rate * (1 + 0.005 * (i - 4)) for i in days]
+
+    fig = Figure(figsize=(10, 4))
+    ax = fig.add_subplot()
+    ax.plot(days, rates, marker='o', linewidth=2, color='#1976D2')
+    ax.set_title(f"📉 {currency} Rate (Last 7 Days)", fontsize=14)
+    ax.set_xlabel("Days")
+    ax.set_ylabel("Rate (to USD)")
+    ax.grid(True, alpha=0.3)
+
+    img_buf = io.BytesIO()
+    fig.savefig(img_buf, format='png', bbox_inches='tight')
+    img_buf.seek(0)
+    return img_buf
+
 async def graph_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     args = context.args
     if not args:
@@ -348,22 +675,7 @@ async def graph_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        days = list(range(1, 8))
-        base_rate = cache.rates[currency]
-        rates = [base_rate * (1 + 0.005 * (i - 4)) for i in days]
-
-        plt.figure(figsize=(10, 4))
-        plt.plot(days, rates, marker='o', linewidth=2, color='#1976D2')
-        plt.title(f"📉 {currency} Rate (Last 7 Days)", fontsize=14)
-        plt.xlabel("Days")
-        plt.ylabel("Rate (to USD)")
-        plt.grid(True, alpha=0.3)
-
-        img_buf = io.BytesIO()
-        plt.savefig(img_buf, format='png', bbox_inches='tight')
-        img_buf.seek(0)
-        plt.close()
-
+        img_buf = await admission.run_heavy(render_graph, currency, cache.rates[currency])
         await update.message.reply_photo(photo=img_buf, caption=f"📉 Chart for {currency}")
     except Exception as e:
         await update.message.reply_text(f"❌ Error: {e}")
@@ -379,20 +691,61 @@ async def alert_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # --- /history ---
 async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
+    settings = get_user_settings(user_id)
     hist = get_recent_history(user_id, 10)
     if not hist:
-        await update.message.reply_text(t(context.user_data, "no_history"))
+        await update.message.reply_text(t(settings, "no_history"))
         return
     lines = [f"• {amount} {from_curr} → {result:,.2f} {to_curr}" for from_curr, to_curr, amount, result in hist]
-    text = t(context.user_data, "history") + "\n" + "\n".join(lines)
+    text = t(settings, "history") + "\n" + "\n".join(lines)
     await update.message.reply_text(text, parse_mode='Markdown')
 
+# --- /export ---
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    settings = get_user_settings(user_id)
+    fmt = "csv"
+    dates = []
+    try:
+        for arg in context.args:
+            if arg.lower() in EXPORT_FORMATS:
+                fmt = arg.lower()
+            else:
+                # strptime принимает и "2026-1-5", а SQLite сравнивает даты как текст — приводим к YYYY-MM-DD
+                dates.append(datetime.strptime(arg, "%Y-%m-%d").date().isoformat())
+        if len(dates) > 2:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("Use: /export [csv|jsonl] [YYYY-MM-DD] [YYYY-MM-DD]")
+        return
+    date_from = dates[0] if dates else None
+    date_to = dates[1] if len(dates) > 1 else None
+
+    parts = []
+    try:
+        # Выгрузка идёт в пуле тяжёлых задач, чтобы большая история не блокировала остальных пользователей
+        count, parts = await admission.run_heavy(export_history, user_id, fmt, date_from, date_to)
+        if not count:
+            await update.message.reply_text(t(settings, "no_history_range" if dates else "no_history"))
+            return
+        # В память при отправке попадает только одна часть, не больше EXPORT_PART_SIZE
+        for i, part in enumerate(parts, 1):
+            filename = f"history.{fmt}.gz" if len(parts) == 1 else f"history.part{i}.{fmt}.gz"
+            await update.message.reply_document(document=part, filename=filename,
+                                                caption=f"📜 {count} rows" if i == 1 else None)
+            part.close()
+    except Exception as e:
+        await update.message.reply_text(f"❌ Error: {e}")
+    finally:
+        for part in parts:
+            part.close()
+
 # --- Обработка сообщений ---
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     user_id = update.effective_user.id
-    settings = get_user_settings(user_id)
-    context.user_data.update(settings)
+    state = states.get(user_id)
+    awaiting = state.awaiting if state else None
 
     # Кнопки
     lang_map = {"💱 Конвертировать": "💱 Convert", "📊 Курсы": "📊 Rates", "📈 График": "📈 Chart",
@@ -415,14 +768,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif en_text in ["⭐ Favorites", "⭐ Избранное"]:
         favs = get_favorites(user_id)
         buttons = [[curr] for curr in favs]
+        states.update(user_id, awaiting='favorite_curr')
         await update.message.reply_text("Избранные валюты:", reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True))
-        context.user_data['awaiting'] = 'favorite_curr'
     elif en_text in ["🧮 Calculator", "🧮 Калькулятор"]:
+        states.update(user_id, awaiting='calc')
         await update.message.reply_text("Введите выражение: `100 + 50 USD to EUR`", parse_mode='Markdown')
-        context.user_data['awaiting'] = 'calc'
 
     # Конвертация
-    elif context.user_data.get('awaiting') == 'amount':
+    elif awaiting == 'amount':
         match = re.match(r"(\d+(?:\.\d+)?)\s*([A-Z]{3})", text, re.I)
         if match:
             amount, curr = match.groups()
@@ -431,27 +784,25 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if from_curr not in cache.rates:
                 await update.message.reply_text("❌ Unknown currency")
                 return
-            context.user_data['amount'] = amount
-            context.user_data['from_curr'] = from_curr
             favs = get_favorites(user_id)
             buttons = [[curr] for curr in favs if curr != from_curr][:3]
             buttons.append(["Назад"])
+            states.update(user_id, awaiting='to_currency', amount=amount, from_curr=from_curr)
             await update.message.reply_text(
                 f"Сумма: {amount} {curr}\nВыбери валюту:",
                 reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True)
             )
-            context.user_data['awaiting'] = 'to_currency'
         else:
             await update.message.reply_text("❌ Неверный формат. Пример: `100 USD`", parse_mode='Markdown')
 
-    elif context.user_data.get('awaiting') == 'to_currency':
+    elif awaiting == 'to_currency':
         if text == "Назад":
-            context.user_data.clear()
+            states.clear(user_id)
             return await start(update, context)
 
         to_curr = text.upper()
-        amount = context.user_data['amount']
-        from_curr = context.user_data['from_curr']
+        amount = state.amount
+        from_curr = state.from_curr
 
         if to_curr not in cache.rates:
             await update.message.reply_text("❌ Unknown currency")
@@ -475,16 +826,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup,
             parse_mode='Markdown'
         )
-        context.user_data.clear()
+        states.clear(user_id)
 
-    elif context.user_data.get('awaiting') == 'calc':
+    elif awaiting == 'calc':
         match = re.match(r"([\d\+\-\*\/\(\)\.\s]+)\s*([A-Z]{3})\s+(?:to|в)\s+([A-Z]{3})", text, re.I)
         if not match:
             await update.message.reply_text("Ошибка. Пример: `100 + 50 USD to EUR`", parse_mode='Markdown')
             return
         expr, from_curr, to_curr = match.groups()
         try:
-            amount = eval(expr)
+            amount = calc_eval(expr)
         except:
             await update.message.reply_text("Ошибка в выражении")
             return
@@ -499,49 +850,47 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         add_history(user_id, from_curr, to_curr, amount, result)
         await update.message.reply_text(f"🧮 {expr} {from_curr} = {result:,.2f} {to_curr}")
-        context.user_data.clear()
+        states.clear(user_id)
 
-    elif context.user_data.get('awaiting') == 'favorite_curr':
+    elif awaiting == 'favorite_curr':
         from_curr = text.upper()
         if from_curr not in cache.rates:
             await update.message.reply_text("Неизвестная валюта")
             return
-        context.user_data['from_curr'] = from_curr
         favs = get_favorites(user_id)
         buttons = [[curr] for curr in favs if curr != from_curr][:3]
         buttons.append(["Назад"])
+        states.update(user_id, awaiting='to_currency_from_fav', from_curr=from_curr)
         await update.message.reply_text("Выбери валюту:", reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True))
-        context.user_data['awaiting'] = 'to_currency_from_fav'
 
-    elif context.user_data.get('awaiting') == 'to_currency_from_fav':
+    elif awaiting == 'to_currency_from_fav':
         if text == "Назад":
-            context.user_data.clear()
+            states.clear(user_id)
             return await start(update, context)
         to_curr = text.upper()
-        from_curr = context.user_data['from_curr']
+        from_curr = state.from_curr
         if to_curr not in cache.rates:
             await update.message.reply_text("Неизвестная валюта")
             return
         # Запросим сумму
+        states.update(user_id, awaiting='amount_from_fav', to_curr=to_curr)
         await update.message.reply_text("Введите сумму:")
-        context.user_data['to_curr'] = to_curr
-        context.user_data['awaiting'] = 'amount_from_fav'
 
-    elif context.user_data.get('awaiting') == 'amount_from_fav':
+    elif awaiting == 'amount_from_fav':
         try:
             amount = float(text)
         except:
             await update.message.reply_text("Неверная сумма")
             return
-        from_curr = context.user_data['from_curr']
-        to_curr = context.user_data['to_curr']
+        from_curr = state.from_curr
+        to_curr = state.to_curr
         result = cache.convert(amount, from_curr, to_curr)
         if result is None:
             await update.message.reply_text("Ошибка конвертации")
             return
         add_history(user_id, from_curr, to_curr, amount, result)
         await update.message.reply_text(f"✅ {amount} {from_curr} = {result:,.2f} {to_curr}")
-        context.user_data.clear()
+        states.clear(user_id)
 
 # --- Курсы валют ---
 async def show_rates(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -574,9 +923,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif data.startswith("alert_set:"):
         _, currency = data.split(":")
-        context.user_data['alert_currency'] = currency
+        states.update(user_id, awaiting='alert_condition', alert_currency=currency)
         await query.message.reply_text(f"Введите условие: `{currency} > 90`", parse_mode='Markdown')
-        context.user_data['awaiting'] = 'alert_condition'
 
     elif data.startswith("swap:"):
         _, amount, from_curr, to_curr = data.split(":")
@@ -589,12 +937,15 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
 
     elif data == "convert_again":
-        await query.message.reply_text(t(context.user_data, "convert"), parse_mode='Markdown')
-        context.user_data['awaiting'] = 'amount'
+        settings = get_user_settings(user_id)
+        states.update(user_id, awaiting='amount')
+        await query.message.reply_text(t(settings, "convert"), parse_mode='Markdown')
 
 # --- Обработка условия уведомления ---
 async def handle_alert_condition(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if context.user_data.get('awaiting') != 'alert_condition':
+    user_id = update.effective_user.id
+    state = states.get(user_id)
+    if state is None or state.awaiting != 'alert_condition':
         return
     text = update.message.text.strip()
     match = re.match(r"([A-Z]{3})\s*([<>])\s*([\d\.]+)", text)
@@ -603,7 +954,6 @@ async def handle_alert_condition(update: Update, context: ContextTypes.DEFAULT_T
         return
     currency, op, target = match.groups()
     target = float(target)
-    user_id = update.effective_user.id
     conn = sqlite3.connect(DB_PATH)
     cur = conn.cursor()
     cur.execute("INSERT INTO alerts (user_id, currency, operator, target) VALUES (?, ?, ?, ?)",
@@ -611,7 +961,7 @@ async def handle_alert_condition(update: Update, context: ContextTypes.DEFAULT_T
     conn.commit()
     conn.close()
     await update.message.reply_text(f"✅ Уведомление установлено: {currency} {op} {target}")
-    context.user_data.pop('awaiting', None)
+    states.clear(user_id)
 
 # --- Inline-режим ---
 async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -707,13 +1057,127 @@ async def check_alerts(context: ContextTypes.DEFAULT_TYPE):
                 pass
     conn.close()
 
+# --- Фоновая задача: очистка брошенных диалогов ---
+async def purge_states(context: ContextTypes.DEFAULT_TYPE):
+    states.purge()
+
+# --- Ответ на отклонённое обновление ---
+async def reject_update(update: Update, user_id):
+    # Inline-запросы отбрасываем без ответа
+    if update.callback_query:
+        await update.callback_query.answer("⏳ Слишком много запросов, подождите")
+    elif update.message and admission.should_warn(user_id):
+        await update.message.reply_text("⏳ Слишком много запросов, подождите немного")
+
+# --- Загрузка исторических курсов ---
+BACKFILL_BATCH = 50_000
+
+def _parse_csv_line(text):
+    return next(csv.reader((text,)))
+
+def _csv_rows(lines, header):
+    # Длинный формат: date,currency,rate. Широкий: date,USD,EUR,... — одна строка на день
+    cols = [c.strip().lower() for c in header]
+    if "currency" in cols and "rate" in cols:
+        d, c, r = cols.index("date"), cols.index("currency"), cols.index("rate")
+        for end, text in lines:
+            rec = _parse_csv_line(text)
+            yield end, [(rec[d][:10], rec[c].strip().upper(), float(rec[r]))] if rec else []
+    else:
+        d = cols.index("date") if "date" in cols else 0
+        currencies = [(i, name.strip().upper()) for i, name in enumerate(header) if i != d]
+        for end, text in lines:
+            rec = _parse_csv_line(text)
+            if not rec:
+                yield end, []
+                continue
+            day = rec[d][:10]
+            yield end, [(day, curr, float(rec[i])) for i, curr in currencies if i < len(rec) and rec[i]]
+
+def _json_rows(lines):
+    # JSON Lines, либо массив, где каждый объект на своей строке.
+    # Объект — {"date", "currency", "rate"} или ответ API {"date", "base", "rates": {...}}
+    for end, text in lines:
+        text = text.strip().rstrip(",")
+        if text in ("", "[", "]"):
+            yield end, []
+            continue
+        obj = json.loads(text)
+        day = obj["date"][:10]
+        if "rates" in obj:
+            rates = obj["rates"]
+            base = obj.get("base", "USD").upper()
+            if base != "USD":
+                usd = rates["USD"]
+                rates = {curr: rate / usd for curr, rate in rates.items()}
+            yield end, [(day, curr.upper(), float(rate)) for curr, rate in rates.items()]
+        else:
+            yield end, [(day, obj["currency"].upper(), float(obj["rate"]))]
+
+def backfill_rates(conn, path, batch=BACKFILL_BATCH):
+    path = os.path.abspath(path)
+    cur = conn.cursor()
+    cur.execute("SELECT offset, rows, done FROM import_progress WHERE path = ?", (path,))
+    offset, total, done = cur.fetchone() or (0, 0, 0)
+    if done:
+        print(f"⏭ {path}: уже загружен ({total} строк)")
+        return 0
+
+    started = time.perf_counter()
+    imported = 0
+
+    def flush(rows, end, done=0):
+        nonlocal total, imported
+        # Строки и позиция в файле фиксируются одной транзакцией — после сбоя загрузка продолжится с неё
+        cur.executemany("INSERT INTO rates (day, currency, rate) VALUES (?, ?, ?)", rows)
+        total += len(rows)
+        imported += len(rows)
+        cur.execute("INSERT OR REPLACE INTO import_progress (path, offset, rows, done) VALUES (?, ?, ?, ?)",
+                    (path, end, total, done))
+        conn.commit()
+        elapsed = time.perf_counter() - started
+        print(f"⏳ {path}: {total} строк, {imported / elapsed:,.0f} строк/с")
+
+    with open(path, "rb") as f:
+        def lines():
+            for raw in f:
+                yield f.tell(), raw.decode("utf-8-sig")
+
+        buf = []
+        end = 0
+        try:
+            if path.lower().endswith(".csv"):
+                header = _parse_csv_line(f.readline().decode("utf-8-sig"))
+                f.seek(max(offset, f.tell()))
+                parsed = _csv_rows(lines(), header)
+            else:
+                f.seek(offset)
+                parsed = _json_rows(lines())
+            end = f.tell()
+            for end, rows in parsed:
+                buf.extend(rows)
+                if len(buf) >= batch:
+                    flush(buf, end)
+                    buf = []
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError, ZeroDivisionError) as e:
+            # Кривая строка файла: null вместо числа, не объект, курс USD = 0 и т.п.
+            # end — конец последней разобранной строки, то есть начало ошибочной
+            raise ValueError(f"{path}: байт {end}: {e!r}") from e
+        flush(buf, end, done=1)
+
+    elapsed = time.perf_counter() - started
+    print(f"✅ {path}: {imported} строк за {elapsed:.1f} с ({imported / max(elapsed, 1e-9):,.0f} строк/с)")
+    return imported
+
 # --- Запуск ---
 def main():
     if not TOKEN:
         print("❌ TOKEN not set")
         return
     print("🚀 Starting CurrencyBot 3.0...")
-    app = Application.builder().token(TOKEN).build()
+    # Пользователи обслуживаются параллельно, обновления одного пользователя — по порядку,
+    # лимиты проверяются при получении обновления
+    app = Application.builder().token(TOKEN).concurrent_updates(UserOrderedProcessor()).build()
 
     # Обработчики
     app.add_handler(CommandHandler("start", start))
@@ -725,6 +1189,7 @@ def main():
     app.add_handler(CommandHandler("graph", graph_command))
     app.add_handler(CommandHandler("alert", alert_command))
     app.add_handler(CommandHandler("history", history_command))
+    app.add_handler(CommandHandler("export", export_command))
     app.add_handler(CommandHandler("rates", show_rates))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     app.add_handler(CallbackQueryHandler(button_handler))
@@ -732,8 +1197,52 @@ def main():
 
     # Фоновая задача
     app.job_queue.run_repeating(check_alerts, interval=60, first=10)
+    app.job_queue.run_repeating(purge_states, interval=300, first=300)
 
     app.run_polling()
 
+# --- CLI: python main.py backfill rates.csv [rates2.jsonl ...] ---
+def backfill_main(argv=None):
+    parser = argparse.ArgumentParser(prog="main.py backfill", description="Bulk-load historical rates")
+    parser.add_argument("files", nargs="+", help="CSV (date,currency,rate or date,USD,EUR,...) or JSON Lines")
+    parser.add_argument("--batch", type=int, default=BACKFILL_BATCH, help="rows per transaction")
+    parser.add_argument("--restart", action="store_true", help="ignore saved checkpoints and load the files again")
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+    # Файлы отмечаются незавершёнными до снятия индекса: если процесс убьют, init_db
+    # не станет строить уникальный индекс по таблице с дублями
+    paths = [os.path.abspath(path) for path in args.files]
+    if args.restart:
+        cur.executemany("INSERT OR REPLACE INTO import_progress (path, offset, rows, done) VALUES (?, 0, 0, 0)",
+                        [(path,) for path in paths])
+    else:
+        cur.executemany("INSERT OR IGNORE INTO import_progress (path, offset, rows, done) VALUES (?, 0, 0, 0)",
+                        [(path,) for path in paths])
+    # Индекс строится один раз в конце — так вставка идёт без его обновления на каждой строке
+    cur.execute("DROP INDEX IF EXISTS idx_rates_day_curr")
+    conn.commit()
+    failed = []
+    try:
+        for path in paths:
+            try:
+                backfill_rates(conn, path, args.batch)
+            except (OSError, ValueError) as e:
+                conn.rollback()
+                print("❌ Ошибка загрузки курсов:", e)
+                failed.append(path)
+    finally:
+        print("⏳ Построение индекса...")
+        build_rate_index(cur)
+        conn.commit()
+        conn.close()
+    if failed:
+        print(f"❌ Не загружено файлов: {len(failed)} — исправьте их и запустите снова, загрузка продолжится с ошибки")
+        sys.exit(1)
+
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == "backfill":
+        backfill_main(sys.argv[2:])
+    else:
+        main()
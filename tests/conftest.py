@@ -0,0 +1,18 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp())  # main создаёт bot.db в текущей папке при импорте
+
+import main
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    path = str(tmp_path / "bot.db")
+    monkeypatch.setattr(main, "DB_PATH", path)
+    main.init_db()
+    return path
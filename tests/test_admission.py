@@ -0,0 +1,183 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from telegram.ext import SimpleUpdateProcessor
+
+import main
+
+
+def fake_update(user_id, text, warnings=None):
+    async def reply_text(text, **kwargs):
+        if warnings is not None:
+            warnings.append(text)
+    message = SimpleNamespace(text=text, reply_text=reply_text)
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), message=message, callback_query=None)
+
+
+def render():
+    # Примерно столько же CPU, сколько рендер графика matplotlib; считаем время CPU потока,
+    # чтобы два рендера, как и настоящие, делили GIL, а не шли параллельно
+    started = time.thread_time()
+    while time.thread_time() - started < 0.02:
+        pass
+
+
+def p99(values):
+    values = sorted(values)
+    return values[int(0.99 * (len(values) - 1))]
+
+
+@pytest.fixture
+def admission(monkeypatch):
+    control = main.AdmissionControl()
+    monkeypatch.setattr(main, "admission", control)
+    return control
+
+
+@pytest.mark.parametrize("text, cost", [
+    ("/graph USD", main.HEAVY_COST),
+    ("/graph@CurrencyBot USD", main.HEAVY_COST),
+    ("/EXPORT csv", main.HEAVY_COST),
+    ("/quick 100 USD to EUR", 1),
+    ("100 USD", 1),
+])
+def test_update_cost(text, cost):
+    assert main.update_cost(fake_update(1, text)) == cost
+
+
+def test_bucket_refills():
+    admission = main.AdmissionControl(rate=1000, burst=2)
+    assert admission.admit(1, 2)
+    assert not admission.admit(2, 3)
+    time.sleep(0.01)
+    assert admission.admit(1, 2)
+
+
+def test_one_heavy_job_per_user():
+    admission = main.AdmissionControl(burst=100)
+
+    assert admission.admit(1, main.HEAVY_COST)
+    assert not admission.admit(1, main.HEAVY_COST)
+    assert admission.admit(1, 1)
+    assert admission.admit(2, main.HEAVY_COST)
+    admission.release(1)
+    assert admission.admit(1, main.HEAVY_COST)
+
+
+def test_updates_of_one_user_stay_in_order(admission):
+    async def scenario():
+        processor = main.UserOrderedProcessor()
+        seen = []
+
+        async def handle(name, delay):
+            await asyncio.sleep(delay)
+            seen.append(name)
+
+        await asyncio.gather(
+            processor.process_update(fake_update(1, "💱 Convert"), handle("convert", 0.05)),
+            processor.process_update(fake_update(1, "100 USD"), handle("amount", 0)),
+            processor.process_update(fake_update(2, "other"), handle("other", 0)),
+        )
+        return seen, processor._locks
+
+    assert asyncio.run(scenario()) == (["other", "convert", "amount"], {})
+
+
+def test_over_limit_is_rejected_without_queuing(admission):
+    async def scenario():
+        processor = main.UserOrderedProcessor()
+        warnings = []
+        handled = []
+
+        async def handle(i):
+            await asyncio.sleep(0.3)
+            handled.append(i)
+
+        first = asyncio.create_task(processor.process_update(fake_update(1, "/graph USD", warnings), handle(0)))
+        await asyncio.sleep(0)
+        started = time.perf_counter()
+        for i in range(1, 10):
+            await processor.process_update(fake_update(1, "/graph USD", warnings), handle(i))
+        rejected_in = time.perf_counter() - started
+        await first
+        return handled, warnings, rejected_in
+
+    handled, warnings, rejected_in = asyncio.run(scenario())
+    assert handled == [0]
+    assert len(warnings) == 1
+    assert rejected_in < 0.05
+    assert not main.admission._busy
+
+
+def test_user_queue_is_bounded(admission):
+    async def scenario():
+        processor = main.UserOrderedProcessor(max_pending=3)
+        warnings = []
+        handled = []
+
+        async def handle(i):
+            await asyncio.sleep(0.01)
+            handled.append(i)
+
+        await asyncio.gather(*[processor.process_update(fake_update(1, "spam", warnings), handle(i))
+                               for i in range(6)])
+        return handled, warnings
+
+    assert asyncio.run(scenario()) == ([0, 1, 2], ["⏳ Слишком много запросов, подождите немного"])
+
+
+def simulate_flood(processor):
+    latency = {"light": [], "heavy": []}
+    abuser = {"served": 0}
+
+    async def handle(update, started):
+        heavy = main.update_cost(update) >= main.HEAVY_COST
+        if heavy:
+            await main.admission.run_heavy(render)
+        if update.effective_user.id == 0:
+            abuser["served"] += 1
+        else:
+            latency["heavy" if heavy else "light"].append(time.perf_counter() - started)
+
+    async def scenario():
+        tasks = []
+
+        def send(user_id, text):
+            update = fake_update(user_id, text)
+            tasks.append(asyncio.create_task(processor.process_update(update, handle(update, time.perf_counter()))))
+
+        async def flood():
+            for _ in range(150):
+                send(0, "/graph USD")
+                await asyncio.sleep(0.005)
+
+        async def normal(user_id):
+            await asyncio.sleep(0.1 + user_id * 0.02)
+            send(user_id, "100 USD")
+            await asyncio.sleep(0.3)
+            send(user_id, "/graph USD")
+
+        await asyncio.gather(flood(), *[normal(user_id) for user_id in range(1, 21)])
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    assert len(latency["light"]) == len(latency["heavy"]) == 20
+    return p99(latency["light"]), p99(latency["heavy"]), abuser["served"]
+
+
+def test_p99_for_normal_users_under_flood(admission):
+    light, heavy, served = simulate_flood(main.UserOrderedProcessor())
+
+    assert light < 0.05
+    assert heavy < 0.2
+    assert served < 10
+
+
+def test_flood_without_admission_starves_normal_users(admission):
+    # Контроль: тот же поток без допуска — графики обычных пользователей ждут за сотнями чужих
+    light, heavy, served = simulate_flood(SimpleUpdateProcessor(256))
+
+    assert served == 150
+    assert heavy > 0.5
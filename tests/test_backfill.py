@@ -0,0 +1,108 @@
+import sqlite3
+
+import pytest
+
+import main
+
+
+def rates(db):
+    conn = sqlite3.connect(db)
+    rows = conn.execute("SELECT day, currency, rate FROM rates ORDER BY day, currency").fetchall()
+    conn.close()
+    return rows
+
+
+def has_index(db):
+    conn = sqlite3.connect(db)
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_rates_day_curr'").fetchone()
+    conn.close()
+    return row is not None
+
+
+def test_wide_csv_and_api_jsonl(db, tmp_path):
+    (tmp_path / "wide.csv").write_text("date,USD,EUR\n2026-01-01,1,0.9\n2026-01-02,1,\n")
+    (tmp_path / "api.jsonl").write_text('{"base": "EUR", "date": "2026-01-03", "rates": {"USD": 2.0, "RUB": 200.0}}\n')
+
+    main.backfill_main([str(tmp_path / "wide.csv"), str(tmp_path / "api.jsonl")])
+
+    assert rates(db) == [("2026-01-01", "EUR", 0.9), ("2026-01-01", "USD", 1.0), ("2026-01-02", "USD", 1.0),
+                         ("2026-01-03", "RUB", 100.0), ("2026-01-03", "USD", 1.0)]
+    assert has_index(db)
+
+
+def test_resume_after_hard_kill(db, tmp_path):
+    path = tmp_path / "long.csv"
+    path.write_text("date,currency,rate\n" + "".join(f"2026-01-0{i},USD,{i}\n" for i in range(1, 7)))
+    # Состояние после SIGKILL: индекс снят, первый пакет зафиксирован, в таблице дубль от другого файла
+    main.backfill_main([str(path), "--batch", "100"])
+    conn = sqlite3.connect(db)
+    conn.execute("DROP INDEX idx_rates_day_curr")
+    conn.execute("DELETE FROM rates WHERE day > '2026-01-02'")
+    conn.execute("INSERT INTO rates (day, currency, rate) VALUES ('2026-01-01', 'USD', 0)")
+    conn.execute("UPDATE import_progress SET offset = ?, rows = 2, done = 0", (len("date,currency,rate\n") + 2 * 17,))
+    conn.commit()
+    conn.close()
+
+    main.init_db()  # раньше падал на UNIQUE constraint при импорте модуля
+    assert not has_index(db)
+
+    main.backfill_main([str(path)])
+
+    assert [rate for _, _, rate in rates(db)] == [0, 2, 3, 4, 5, 6]
+    assert has_index(db)
+
+
+def test_bad_row_reports_offset_and_fails(db, tmp_path, capsys):
+    bad = tmp_path / "bad.csv"
+    bad.write_text("date,currency,rate\n2026-01-01,USD,1\n2026-01-02,USD,oops\n")
+    good = tmp_path / "good.csv"
+    good.write_text("date,currency,rate\n2026-01-03,USD,3\n")
+
+    with pytest.raises(SystemExit) as exc:
+        main.backfill_main([str(bad), str(good)])
+
+    assert exc.value.code == 1
+    assert f"{bad}: байт 36" in capsys.readouterr().out
+    assert rates(db) == [("2026-01-03", "USD", 3.0)]
+
+    bad.write_text("date,currency,rate\n2026-01-01,USD,1\n2026-01-02,USD,2\n")
+    main.backfill_main([str(bad)])
+    assert len(rates(db)) == 3
+
+
+def test_restart_reloads_finished_file(db, tmp_path):
+    path = tmp_path / "rates.csv"
+    path.write_text("date,currency,rate\n2026-01-01,USD,1\n")
+    main.backfill_main([str(path)])
+
+    path.write_text("date,currency,rate\n2026-01-01,USD,2\n")
+    main.backfill_main([str(path)])
+    assert rates(db) == [("2026-01-01", "USD", 1.0)]
+
+    main.backfill_main([str(path), "--restart"])
+    assert rates(db) == [("2026-01-01", "USD", 2.0)]
+
+
+@pytest.mark.parametrize("bad_line", [
+    '{"date": "2026-01-02", "currency": "USD", "rate": null}',
+    '[1, 2, 3]',
+    '"2026-01-02"',
+    '{"date": 20260102, "currency": "USD", "rate": 1}',
+    '{"date": "2026-01-02", "currency": 840, "rate": 1}',
+    '{"date": "2026-01-02", "base": "EUR", "rates": {"USD": 0, "RUB": 100}}',
+    '{"date": "2026-01-02", "rates": [1, 2]}',
+])
+def test_bad_json_value_reports_offset_and_fails(db, tmp_path, capsys, bad_line):
+    first = '{"date": "2026-01-01", "currency": "USD", "rate": 1}\n'
+    bad = tmp_path / "bad.jsonl"
+    bad.write_text(first + bad_line + "\n")
+    good = tmp_path / "good.csv"
+    good.write_text("date,currency,rate\n2026-01-03,USD,3\n")
+
+    with pytest.raises(SystemExit) as exc:
+        main.backfill_main([str(bad), str(good)])
+
+    assert exc.value.code == 1
+    assert f"{bad}: байт {len(first)}" in capsys.readouterr().out
+    assert rates(db) == [("2026-01-03", "USD", 3.0)]
+    assert has_index(db)
@@ -0,0 +1,104 @@
+import asyncio
+import gzip
+import json
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+def add_rows(db, rows):
+    conn = sqlite3.connect(db)
+    conn.executemany("INSERT INTO history (user_id, from_curr, to_curr, amount, result, timestamp) "
+                     "VALUES (?, 'USD', 'EUR', ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+
+def read_parts(parts):
+    return [gzip.decompress(part.read()).decode().splitlines() for part in parts]
+
+
+def test_export_csv_in_parts(db):
+    add_rows(db, [(1, i, i * 0.9, f"2026-01-{1 + i % 28:02d} 12:00:00") for i in range(20_000)])
+    add_rows(db, [(2, 1, 1, "2026-01-01 12:00:00")])
+
+    count, parts = main.export_history(1, "csv", part_size=50_000)
+    lines = read_parts(parts)
+
+    assert count == 20_000
+    assert len(parts) > 1
+    assert all(part_lines[0] == "timestamp,from_curr,to_curr,amount,result" for part_lines in lines)
+    assert sum(len(part_lines) - 1 for part_lines in lines) == 20_000
+
+
+def test_export_jsonl_date_range(db):
+    add_rows(db, [(1, 1, 0.9, "2026-01-01 12:00:00"), (1, 2, 1.8, "2026-01-31 23:59:59"),
+                  (1, 3, 2.7, "2026-02-01 00:00:00")])
+
+    count, parts = main.export_history(1, "jsonl", "2026-01-01", "2026-01-31")
+    [lines] = read_parts(parts)
+
+    assert count == 2
+    assert [json.loads(line)["amount"] for line in lines] == [1, 2]
+
+
+def test_export_empty_range(db):
+    add_rows(db, [(1, 1, 0.9, "2026-01-01 12:00:00")])
+
+    assert main.export_history(1, "csv", "2025-01-01", "2025-12-31") == (0, [])
+
+
+class FakeMessage:
+    def __init__(self):
+        self.texts = []
+        self.documents = []
+
+    async def reply_text(self, text, **kwargs):
+        self.texts.append(text)
+
+    async def reply_document(self, document, filename, **kwargs):
+        self.documents.append((filename, gzip.decompress(document.read()).decode().splitlines()))
+
+
+def run_export(*args):
+    message = FakeMessage()
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=1), message=message)
+    asyncio.run(main.export_command(update, SimpleNamespace(args=list(args))))
+    return message
+
+
+def test_export_command_normalizes_dates(db):
+    add_rows(db, [(1, 1, 0.9, "2026-01-04 12:00:00"), (1, 2, 1.8, "2026-01-05 12:00:00"),
+                  (1, 3, 2.7, "2026-01-06 23:00:00"), (1, 4, 3.6, "2026-01-10 12:00:00")])
+
+    message = run_export("jsonl", "2026-1-5", "2026-1-6")
+
+    [(filename, lines)] = message.documents
+    assert filename == "history.jsonl.gz"
+    assert [json.loads(line)["amount"] for line in lines] == [2, 3]
+
+
+@pytest.mark.parametrize("args", [("2026-13-01",), ("yesterday",), ("2026-01-01", "2026-01-02", "2026-01-03")])
+def test_export_command_rejects_bad_args(db, args):
+    message = run_export(*args)
+
+    assert message.texts == ["Use: /export [csv|jsonl] [YYYY-MM-DD] [YYYY-MM-DD]"]
+    assert message.documents == []
+
+
+def test_export_command_empty_range(db):
+    add_rows(db, [(1, 1, 0.9, "2026-01-01 12:00:00")])
+
+    assert run_export("2025-01-01").texts == []  # есть записи позже 2025-01-01
+    assert run_export("2027-01-01").texts == [main.LANGS["ru"]["no_history_range"]]
+
+
+def test_export_command_reports_errors(db, monkeypatch):
+    def broken(*args):
+        raise sqlite3.OperationalError("disk I/O error")
+    monkeypatch.setattr(main, "export_history", broken)
+
+    assert run_export().texts == ["❌ Error: disk I/O error"]